@@ -0,0 +1,179 @@
+"""Unit tests for the ASR agent."""
+
+import os
+import struct
+import tempfile
+import wave
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pytest
+
+
+def write_wav(path, samples, channels, rate, sampwidth=2):
+    with wave.open(path, "wb") as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(sampwidth)
+        wf.setframerate(rate)
+        wf.writeframes(samples)
+
+
+class TestLoadAudio:
+    """Tests for load_audio."""
+
+    @pytest.fixture
+    def tmpdir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield tmpdir
+
+    def test_48khz_stereo_to_16khz_mono(self, tmpdir):
+        from transcribe import load_audio, WHISPER_SAMPLE_RATE
+        path = os.path.join(tmpdir, "stereo.wav")
+        # One second, left=8192 right=0 -> mono 4096 -> 0.125
+        write_wav(path, struct.pack("<2h", 8192, 0) * 48000, 2, 48000)
+
+        audio = load_audio(path)
+
+        assert audio.dtype == np.float32
+        assert audio.shape == (WHISPER_SAMPLE_RATE,)
+        # Away from the filter edges a DC input passes through unchanged
+        assert np.allclose(audio[100:-100], 0.125, atol=1e-3)
+
+    def test_16khz_mono_passes_through(self, tmpdir):
+        from transcribe import load_audio
+        path = os.path.join(tmpdir, "mono.wav")
+        write_wav(path, struct.pack("<3h", 0, 16384, -32768), 1, 16000)
+
+        audio = load_audio(path)
+
+        assert audio.tolist() == [0.0, 0.5, -1.0]
+
+    def test_rejects_non_16_bit(self, tmpdir):
+        from transcribe import load_audio
+        path = os.path.join(tmpdir, "8bit.wav")
+        write_wav(path, b"\x80" * 100, 1, 16000, sampwidth=1)
+
+        with pytest.raises(ValueError):
+            load_audio(path)
+
+
+class TestTranscribeFile:
+    """Tests for transcribe_file."""
+
+    @pytest.fixture
+    def model(self):
+        model = Mock()
+        model.transcribe.return_value = ([Mock(text=" hello"), Mock(text=" world")], None)
+        return model
+
+    def test_passes_decoded_audio(self, model):
+        from transcribe import transcribe_file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "mono.wav")
+            write_wav(path, b"\x00\x00" * 160, 1, 16000)
+
+            text = transcribe_file(model, path)
+
+        assert text == " hello world"
+        assert isinstance(model.transcribe.call_args[0][0], np.ndarray)
+
+    @pytest.mark.parametrize("contents", [b"", b"RIFF", b"not a wav file"])
+    def test_falls_back_to_path_for_unreadable_wav(self, model, contents):
+        from transcribe import transcribe_file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "broken.wav")
+            with open(path, "wb") as f:
+                f.write(contents)
+
+            transcribe_file(model, path)
+
+        model.transcribe.assert_called_once_with(path)
+
+    def test_missing_file_returns_empty(self, model):
+        from transcribe import transcribe_file
+
+        assert transcribe_file(model, "/nonexistent.wav") == ""
+        model.transcribe.assert_not_called()
+
+
+class TestTranscribeExisting:
+    """Tests for transcribe_existing."""
+
+    def test_handles_files_that_land_mid_scan(self):
+        import transcribe
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = os.path.join(tmpdir, "a.wav")
+            late = os.path.join(tmpdir, "b.wav")
+            open(first, "wb").close()
+            open(os.path.join(tmpdir, "notes.txt"), "wb").close()
+            seen = []
+
+            def report(model, file_path):
+                seen.append(file_path)
+                if file_path == first:
+                    open(late, "wb").close()
+
+            with patch.object(transcribe, "report_file", side_effect=report):
+                done = transcribe.transcribe_existing(None, tmpdir)
+
+        assert seen == [first, late]
+        assert done == {first, late}
+
+
+class TestWatchDirectory:
+    """Tests for watch_directory."""
+
+    def test_scans_after_watcher_starts_and_filters_changes(self):
+        import transcribe
+        from watchfiles import Change
+        order = []
+        batches = [
+            set(),
+            {
+                (Change.added, "/in/scanned.wav"),
+                (Change.added, "/in/new.wav"),
+                (Change.modified, "/in/changed.wav"),
+                (Change.deleted, "/in/gone.wav"),
+                (Change.added, "/in/new.wav.part"),
+            },
+        ]
+
+        def fake_watch(*args, **kwargs):
+            order.append("watch")
+            yield from batches
+
+        def fake_scan(model, directory):
+            order.append("scan")
+            return {"/in/scanned.wav"}
+
+        with patch.object(transcribe, "watch", side_effect=fake_watch) as watch, \
+                patch.object(transcribe, "transcribe_existing", side_effect=fake_scan), \
+                patch.object(transcribe, "report_file") as report:
+            transcribe.watch_directory("model", "/in", force_polling=True)
+
+        assert order == ["watch", "scan"]
+        assert watch.call_args.kwargs["force_polling"] is True
+        assert watch.call_args.kwargs["yield_on_timeout"] is True
+        report.assert_called_once_with("model", "/in/new.wav")
+
+
+class TestBuildParser:
+    """Tests for command line parsing."""
+
+    @pytest.mark.parametrize("value, expected", [
+        (None, False), ("1", True), ("true", True), ("YES", True), ("0", False),
+    ])
+    def test_poll_default_from_env(self, monkeypatch, value, expected):
+        from transcribe import build_parser
+        if value is None:
+            monkeypatch.delenv("ASR_FORCE_POLLING", raising=False)
+        else:
+            monkeypatch.setenv("ASR_FORCE_POLLING", value)
+
+        assert build_parser().parse_args(["/in"]).poll is expected
+
+    def test_poll_flag(self, monkeypatch):
+        from transcribe import build_parser
+        monkeypatch.delenv("ASR_FORCE_POLLING", raising=False)
+
+        assert build_parser().parse_args(["/in", "--watch", "--poll"]).poll is True
@@ -1,19 +1,52 @@
 #!/usr/bin/env python3
 """
-ASR Agent - Transcribes WAV files using OpenAI Whisper tiny model.
+ASR Agent - Transcribes WAV files using Whisper (faster-whisper / CTranslate2).
 
 Usage:
     python transcribe.py <path_to_wav_file>
     python transcribe.py --watch <directory>  # Watch directory for new files
+    python transcribe.py --watch --poll <directory>  # Same, for network-shared directories
 """
 
 import argparse
+import math
 import os
 import sys
-import time
+import wave
 from pathlib import Path
 
-import whisper
+import ctranslate2
+import numpy as np
+from faster_whisper import WhisperModel
+from scipy.signal import resample_poly
+from watchfiles import Change, watch
+
+WHISPER_SAMPLE_RATE = 16000
+
+
+def load_model(model_size: str) -> WhisperModel:
+    """Load a quantized Whisper model on the GPU if one is available."""
+    if ctranslate2.get_cuda_device_count() > 0:
+        return WhisperModel(model_size, device="cuda", compute_type="int8_float16")
+    return WhisperModel(model_size, device="cpu", compute_type="int8")
+
+
+def load_audio(file_path: str) -> np.ndarray:
+    """Read a 16-bit PCM WAV file as 16kHz mono float32, the input Whisper expects."""
+    with wave.open(file_path, "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise ValueError(f"Expected 16-bit PCM, got {wf.getsampwidth() * 8}-bit")
+        channels = wf.getnchannels()
+        rate = wf.getframerate()
+        frames = wf.readframes(wf.getnframes())
+
+    samples = np.frombuffer(frames, dtype="<i2").reshape(-1, channels)
+    audio = samples.mean(axis=1, dtype=np.float32) / 32768.0
+
+    if rate != WHISPER_SAMPLE_RATE:
+        gcd = math.gcd(rate, WHISPER_SAMPLE_RATE)
+        audio = resample_poly(audio, WHISPER_SAMPLE_RATE // gcd, rate // gcd)
+    return audio.astype(np.float32, copy=False)
 
 
 def transcribe_file(model, file_path: str) -> str:
@@ -23,29 +56,62 @@ def transcribe_file(model, file_path: str) -> str:
         return ""
 
     print(f"Transcribing: {file_path}")
-    result = model.transcribe(file_path)
-    return result["text"]
-
-
-def watch_directory(model, directory: str, processed_files: set):
-    """Watch a directory for new WAV files and transcribe them."""
-    path = Path(directory)
-
-    for wav_file in path.glob("*.wav"):
-        file_path = str(wav_file)
-        if file_path not in processed_files:
-            text = transcribe_file(model, file_path)
-            if text:
-                print(f"\n{'='*60}")
-                print(f"File: {wav_file.name}")
-                print(f"Transcription: {text.strip()}")
-                print(f"{'='*60}\n")
-            processed_files.add(file_path)
-
-
-def main():
+    try:
+        # Decode our own PCM WAVs directly instead of going through PyAV
+        audio = load_audio(file_path)
+    except (wave.Error, ValueError, EOFError):
+        audio = file_path
+    segments, _ = model.transcribe(audio)
+    return "".join(segment.text for segment in segments)
+
+
+def report_file(model, file_path: str):
+    """Transcribe a WAV file and print the result."""
+    text = transcribe_file(model, file_path)
+    if text:
+        print(f"\n{'='*60}")
+        print(f"File: {Path(file_path).name}")
+        print(f"Transcription: {text.strip()}")
+        print(f"{'='*60}\n")
+
+
+def transcribe_existing(model, directory: str) -> set:
+    """Transcribe WAV files already in a directory, including any that land meanwhile.
+
+    Returns the paths that were handled.
+    """
+    done = set()
+    while True:
+        pending = sorted(str(p) for p in Path(directory).glob("*.wav") if str(p) not in done)
+        if not pending:
+            return done
+        for file_path in pending:
+            report_file(model, file_path)
+            done.add(file_path)
+
+
+def watch_directory(model, directory: str, force_polling: bool = False):
+    """Transcribe existing WAV files, then new ones as they appear.
+
+    inotify does not see files written by another host on a network share,
+    so force_polling falls back to periodic directory scans.
+    """
+    scanned = None
+    # yield_on_timeout gives an early (possibly empty) batch once the watcher is live
+    for changes in watch(directory, force_polling=force_polling,
+                         yield_on_timeout=True, rust_timeout=1000):
+        if scanned is None:
+            # Scan only after the watcher exists so no file can slip between the two
+            scanned = transcribe_existing(model, directory)
+        for change, file_path in sorted(changes, key=lambda c: c[1]):
+            if change == Change.added and file_path.endswith(".wav") and file_path not in scanned:
+                report_file(model, file_path)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the command line parser."""
     parser = argparse.ArgumentParser(
-        description="Transcribe WAV files using Whisper tiny model"
+        description="Transcribe WAV files using Whisper"
     )
     parser.add_argument(
         "input",
@@ -56,17 +122,27 @@ def main():
         action="store_true",
         help="Watch directory for new WAV files continuously"
     )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        default=os.getenv("ASR_FORCE_POLLING", "").lower() in ("1", "true", "yes"),
+        help="Poll instead of using inotify, e.g. for NFS/SMB shares "
+             "(default: $ASR_FORCE_POLLING)"
+    )
     parser.add_argument(
         "--model", "-m",
         default="small",
         choices=["tiny", "base", "small", "medium", "large"],
         help="Whisper model size (default: small)"
     )
+    return parser
+
 
-    args = parser.parse_args()
+def main():
+    args = build_parser().parse_args()
 
     print(f"Loading Whisper {args.model} model...")
-    model = whisper.load_model(args.model)
+    model = load_model(args.model)
     print("Model loaded successfully!")
 
     if args.watch:
@@ -77,12 +153,8 @@ def main():
         print(f"Watching directory: {args.input}")
         print("Press Ctrl+C to stop\n")
 
-        processed_files = set()
-
         try:
-            while True:
-                watch_directory(model, args.input, processed_files)
-                time.sleep(1)
+            watch_directory(model, args.input, force_polling=args.poll)
         except KeyboardInterrupt:
             print("\nStopping watcher...")
     else:
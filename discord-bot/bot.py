@@ -1,14 +1,22 @@
 """Discord bot with Voice Activity Detection for audio capture."""
 
 import os
+import re
 import sys
 import io
-import wave
+import tempfile
+import atexit
 import struct
 import asyncio
 import logging
+import threading
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import onnxruntime
+from scipy.signal import resample_poly
 
 # Suppress ALL discord logging before import
 logging.getLogger("discord").setLevel(logging.CRITICAL)
@@ -17,18 +25,44 @@ import discord
 from discord.ext import commands
 import webrtcvad
 
-# Monkey-patch to suppress opus decode errors on both stdout and stderr
-class FilteredOutput:
-    def __init__(self, original):
-        self._original = original
-    def write(self, msg):
-        if "opus" not in msg.lower() and "decod" not in msg.lower() and "error occurred" not in msg.lower():
-            self._original.write(msg)
-    def flush(self):
-        self._original.flush()
-
-sys.stderr = FilteredOutput(sys.stderr)
-sys.stdout = FilteredOutput(sys.stdout)
+# Opus decode errors to suppress on both stdout and stderr
+NOISE_PATTERN = re.compile(rb"opus|decod|error occurred", re.IGNORECASE)
+
+
+def _filter_pipe(read_fd, out_fd):
+    """Copy lines from read_fd to out_fd, dropping opus decode noise.
+
+    Keeps draining read_fd even once out_fd fails; a full pipe would block every print.
+    """
+    with open(read_fd, "rb") as src:
+        for line in src:
+            if out_fd is None or NOISE_PATTERN.search(line):
+                continue
+            try:
+                _writev_all(out_fd, [line])
+            except OSError:
+                out_fd = None  # Real output is gone (EPIPE, EIO), discard from here on
+
+
+def _restore_output(stream, fd, saved_fd, thread):
+    """Point fd back at the real output and let the filter thread drain."""
+    stream.flush()
+    os.dup2(saved_fd, fd)  # Closes the pipe's write end, so the thread sees EOF
+    thread.join(timeout=1)
+
+
+def install_output_filter():
+    """Filter stdout/stderr at the fd level so C and Python output pass the same filter."""
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+        fd = stream.fileno()
+        saved_fd = os.dup(fd)
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        thread = threading.Thread(target=_filter_pipe, args=(read_fd, saved_fd), daemon=True)
+        thread.start()
+        atexit.register(_restore_output, stream, fd, saved_fd, thread)
 
 # Load opus library for voice
 discord.opus.load_opus("libopus.so.0")
@@ -39,17 +73,109 @@ AUTO_JOIN_CHANNEL_ID = os.getenv("DISCORD_CHANNEL_ID")  # Voice channel to auto-
 AUDIO_OUTPUT_DIR = "/app/audio"
 SAMPLE_RATE = 48000  # Discord default
 CHANNELS = 2  # Discord sends stereo
+OUTPUT_SAMPLE_RATE = 16000  # Saved wavs are 16kHz mono, what Whisper and Silero consume
+OUTPUT_CHANNELS = 1
 FRAME_DURATION_MS = 20  # webrtcvad supports 10, 20, or 30ms
 SILENCE_THRESHOLD_MS = 500  # How long silence before we consider speech ended
 MIN_SPEECH_DURATION_MS = 200  # Ignore very short sounds
 VAD_AGGRESSIVENESS = 3  # 0-3, higher = more aggressive filtering
+VAD_SMOOTHING_FRAMES = 5  # Majority vote over the last N VAD decisions
+VAD_SMOOTHING_THRESHOLD = 3  # Speech frames needed within the window
+SILERO_MODEL_PATH = os.getenv("SILERO_VAD_MODEL", "/app/silero_vad.onnx")  # Second-pass VAD
+SILERO_THRESHOLD = 0.5  # Drop utterances that never reach this speech probability
+SILERO_CHUNK_SAMPLES = 512  # Window size the model expects at 16kHz
+SILERO_CONTEXT_SAMPLES = 64  # Trailing samples of the previous window fed with each chunk
 
 # Calculate frame sizes
 SAMPLES_PER_FRAME = int(SAMPLE_RATE * FRAME_DURATION_MS / 1000)
 BYTES_PER_SAMPLE = 2  # 16-bit audio
 FRAME_SIZE = SAMPLES_PER_FRAME * CHANNELS * BYTES_PER_SAMPLE
+VAD_FRAME_SIZE = SAMPLES_PER_FRAME * BYTES_PER_SAMPLE  # Mono frame fed to webrtcvad
 SILENCE_FRAMES = int(SILENCE_THRESHOLD_MS / FRAME_DURATION_MS)
 MIN_SPEECH_FRAMES = int(MIN_SPEECH_DURATION_MS / FRAME_DURATION_MS)
+MIN_SPEECH_BYTES = MIN_SPEECH_FRAMES * FRAME_SIZE
+
+
+def _create_partial(directory):
+    """Create a unique .part file, creating the directory only if it is missing."""
+    try:
+        return tempfile.mkstemp(dir=directory, suffix=".part")
+    except FileNotFoundError:
+        # First save, or the directory was removed/remounted since
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.mkstemp(dir=directory, suffix=".part")
+
+
+# Output format is fixed, so only the two size fields differ between files
+_WAV_BLOCK_ALIGN = OUTPUT_CHANNELS * BYTES_PER_SAMPLE
+_WAV_HEADER_TEMPLATE = struct.pack(
+    "<4sI4s4sIHHIIHH4sI",
+    b"RIFF", 0, b"WAVE",
+    b"fmt ", 16, 1, OUTPUT_CHANNELS, OUTPUT_SAMPLE_RATE, OUTPUT_SAMPLE_RATE * _WAV_BLOCK_ALIGN,
+    _WAV_BLOCK_ALIGN, BYTES_PER_SAMPLE * 8,
+    b"data", 0,
+)
+
+
+def _wav_header(data_size):
+    """Build the 44-byte PCM wav header for a payload of data_size bytes."""
+    header = bytearray(_WAV_HEADER_TEMPLATE)
+    struct.pack_into("<I", header, 4, 36 + data_size)  # RIFF chunk size
+    struct.pack_into("<I", header, 40, data_size)  # data chunk size
+    return header
+
+
+def _writev_all(fd, buffers):
+    """os.writev that keeps going after a short write."""
+    views = [memoryview(b).cast("B") for b in buffers]
+    while views:
+        written = os.writev(fd, views)
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][written:]
+
+
+class SileroVAD:
+    """Second-pass speech check using the Silero VAD ONNX model."""
+
+    def __init__(self, model_path):
+        opts = onnxruntime.SessionOptions()
+        opts.inter_op_num_threads = 1
+        opts.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+
+    def is_speech(self, audio, threshold=SILERO_THRESHOLD):
+        """Return True if any chunk of 16kHz float32 audio reaches threshold."""
+        state = np.zeros((2, 1, 128), dtype=np.float32)
+        sr = np.array(OUTPUT_SAMPLE_RATE, dtype=np.int64)
+        # Prepend silence so every window has a full context
+        padded = np.concatenate([np.zeros(SILERO_CONTEXT_SAMPLES, dtype=np.float32), audio])
+        window = SILERO_CONTEXT_SAMPLES + SILERO_CHUNK_SAMPLES
+
+        for start in range(0, len(audio) - SILERO_CHUNK_SAMPLES + 1, SILERO_CHUNK_SAMPLES):
+            x = padded[start:start + window][np.newaxis, :]
+            prob, state = self.session.run(None, {"input": x, "state": state, "sr": sr})
+            if prob[0, 0] >= threshold:
+                return True
+        return False
+
+
+class _UserState:
+    """Per-user audio buffer and speech detection state."""
+
+    __slots__ = ("buffer", "speaking", "silence_frames", "mono_tail", "vad_history")
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.speaking = False
+        self.silence_frames = 0
+        # Mono audio not yet classified, and recent VAD decisions
+        self.mono_tail = bytearray()
+        self.vad_history = deque(maxlen=VAD_SMOOTHING_FRAMES)
 
 
 class VADAudioSink(discord.sinks.Sink):
@@ -58,111 +184,161 @@ class VADAudioSink(discord.sinks.Sink):
     def __init__(self):
         super().__init__()
         self.vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
-        # Per-user state
-        self.user_buffers = defaultdict(list)
-        self.user_speaking = defaultdict(bool)
-        self.user_silence_frames = defaultdict(int)
-        self.user_frame_count = defaultdict(int)
-        # Only check VAD every N frames to reduce processing
-        self.vad_check_interval = 5
+        # Per-user state, one lookup per packet
+        self.users = defaultdict(_UserState)
+        self._vad_frame = bytearray(VAD_FRAME_SIZE)  # Reused for every VAD call
+        self.silero = self._load_silero()
+        # Saving runs off the voice receive thread so it never stalls packet handling
+        self._io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="utterance-io")
+
+    def _load_silero(self):
+        """Load the second-pass VAD model, or None if it isn't available."""
+        if not os.path.isfile(SILERO_MODEL_PATH):
+            print(f"Silero VAD model not found at {SILERO_MODEL_PATH}, second pass disabled")
+            return None
+        return SileroVAD(SILERO_MODEL_PATH)
 
     def write(self, data, user_id):
         """Called for each audio packet from a user."""
         if user_id is None or data is None:
             return
 
-        self.user_frame_count[user_id] += 1
+        state = self.users[user_id]
 
         # Only buffer if already speaking
-        if self.user_speaking[user_id]:
-            self.user_buffers[user_id].append(data)
-
-        # Only check VAD every N frames
-        if self.user_frame_count[user_id] % self.vad_check_interval != 0:
-            return
-
-        # Convert stereo to mono for VAD
-        mono_data = self._stereo_to_mono(data)
-        is_speech = self._check_speech(mono_data)
+        if state.speaking:
+            state.buffer.extend(data)
+
+        # Coalesce mono audio and classify every complete VAD frame
+        tail = state.mono_tail
+        tail.extend(self._stereo_to_mono(data).data)
+        offset = 0
+        with memoryview(tail) as view:
+            while len(tail) - offset >= VAD_FRAME_SIZE:
+                self._vad_frame[:] = view[offset:offset + VAD_FRAME_SIZE]
+                offset += VAD_FRAME_SIZE
+                self._update_speech_state(user_id, state, data, self._vad_frame)
+        # Drop classified audio in one move instead of once per frame
+        del tail[:offset]
+
+    def _update_speech_state(self, user_id, state, data, frame):
+        """Advance a user's speech state machine by one VAD frame."""
+        # Smooth single-frame flips with a majority vote
+        state.vad_history.append(bool(self._check_speech(frame)))
+        is_speech = sum(state.vad_history) >= VAD_SMOOTHING_THRESHOLD
 
         if is_speech:
-            if not self.user_speaking[user_id]:
+            if not state.speaking:
                 print(f"[user_{user_id}] Speaking...")
-                self.user_speaking[user_id] = True
-            # Buffer this frame too if we just started
-            if data not in self.user_buffers[user_id]:
-                self.user_buffers[user_id].append(data)
-            self.user_silence_frames[user_id] = 0
-        elif self.user_speaking[user_id]:
-            self.user_silence_frames[user_id] += 1
-
-            if self.user_silence_frames[user_id] >= (SILENCE_FRAMES // self.vad_check_interval):
+                state.speaking = True
+                # Buffer the packet that started the utterance
+                state.buffer.extend(data)
+            state.silence_frames = 0
+        elif state.speaking:
+            state.silence_frames += 1
+
+            if state.silence_frames >= SILENCE_FRAMES:
                 print(f"[user_{user_id}] Silent.")
                 # Speech ended - save wav
-                if len(self.user_buffers[user_id]) >= MIN_SPEECH_FRAMES:
+                if len(state.buffer) >= MIN_SPEECH_BYTES:
                     self._save_utterance(user_id)
 
                 # Reset for next utterance
-                self.user_buffers[user_id] = []
-                self.user_speaking[user_id] = False
-                self.user_silence_frames[user_id] = 0
+                state.buffer = bytearray()
+                state.speaking = False
+                state.silence_frames = 0
 
     def _stereo_to_mono(self, data):
-        """Convert stereo audio to mono by averaging channels."""
+        """Convert stereo audio to a mono int16 array by averaging channels."""
         # Data is 16-bit stereo, so 4 bytes per sample pair
         samples = len(data) // 4
-        mono = []
-        for i in range(samples):
-            left = struct.unpack_from("<h", data, i * 4)[0]
-            right = struct.unpack_from("<h", data, i * 4 + 2)[0]
-            mono_sample = (left + right) // 2
-            mono.append(struct.pack("<h", mono_sample))
-        return b"".join(mono)
+        stereo = np.frombuffer(data, dtype="<i2", count=samples * 2).reshape(-1, 2)
+        # Sum in int32 so left + right can't overflow int16
+        mono = stereo.astype(np.int32)
+        mono = (mono[:, 0] + mono[:, 1]) >> 1
+        return mono.astype("<i2")
+
+    def _resample_output(self, audio_data):
+        """Convert buffered 48kHz stereo audio to 16kHz mono float32 (int16 scale)."""
+        mono = self._stereo_to_mono(audio_data).astype(np.float32)
+        return resample_poly(mono, 1, SAMPLE_RATE // OUTPUT_SAMPLE_RATE).astype(np.float32)
 
     def _check_speech(self, mono_data):
         """Check if audio frame contains speech using webrtcvad."""
         # webrtcvad needs exactly 10, 20, or 30ms of audio
         # At 48kHz, 20ms = 960 samples = 1920 bytes (16-bit)
-        frame_bytes = int(SAMPLE_RATE * FRAME_DURATION_MS / 1000) * 2
-
-        if len(mono_data) < frame_bytes:
+        if len(mono_data) < VAD_FRAME_SIZE:
             return False
 
-        frame = mono_data[:frame_bytes]
         try:
-            return self.vad.is_speech(frame, SAMPLE_RATE)
+            # Pass the frame length instead of slicing so nothing is copied
+            return self.vad.is_speech(mono_data, SAMPLE_RATE, SAMPLES_PER_FRAME)
         except Exception:
             # Silently ignore decode errors
             return False
 
     def _save_utterance(self, user_id):
-        """Save buffered audio as a wav file."""
-        if not self.user_buffers[user_id]:
+        """Hand the user's buffered audio to the io pool to be saved."""
+        state = self.users[user_id]
+        # Take ownership of the buffer so the receive thread can start a new one
+        audio_data, state.buffer = state.buffer, bytearray()
+        # The pool is shut down once recording has finished
+        if not audio_data or self.finished:
+            return None
+        # Timestamp on the receive thread so names follow utterance order
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        return self._io_pool.submit(self._save_utterance_sync, user_id, timestamp, audio_data)
+
+    def _save_utterance_sync(self, user_id, timestamp, audio_data):
+        """Save an utterance as a wav file (runs on the io pool)."""
+        try:
+            self._write_utterance(user_id, timestamp, audio_data)
+        except Exception as e:
+            print(f"Error saving utterance for user_{user_id}: {e}")
+
+    def _write_utterance(self, user_id, timestamp, audio_data):
+        """Downsample, confirm speech with Silero and write the wav file."""
+        # Resample once here so neither Silero nor the ASR agent has to
+        audio = self._resample_output(audio_data)
+
+        # webrtcvad over-triggers on noise - confirm with Silero before saving
+        if self.silero is not None and not self.silero.is_speech(audio / 32768.0):
+            print(f"[user_{user_id}] Dropped utterance (no speech).")
             return
 
-        # Combine all buffered audio
-        audio_data = b"".join(self.user_buffers[user_id])
+        pcm = np.clip(np.rint(audio), -32768, 32767).astype("<i2")
 
         # Generate filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{AUDIO_OUTPUT_DIR}/user_{user_id}_{timestamp}.wav"
 
-        # Write wav file
-        os.makedirs(AUDIO_OUTPUT_DIR, exist_ok=True)
-        with wave.open(filename, "wb") as wf:
-            wf.setnchannels(CHANNELS)
-            wf.setsampwidth(BYTES_PER_SAMPLE)
-            wf.setframerate(SAMPLE_RATE)
-            wf.writeframes(audio_data)
+        # Write wav file - header is built up front so nothing is patched on close.
+        # Write under a unique temp name and rename so watchers never see a partial file.
+        fd, partial = _create_partial(AUDIO_OUTPUT_DIR)
+        try:
+            try:
+                os.fchmod(fd, 0o644)  # mkstemp creates 0600; the ASR agent needs to read it
+                # Header and payload normally go out in a single syscall
+                _writev_all(fd, [_wav_header(pcm.nbytes), pcm])
+            finally:
+                os.close(fd)
+            os.replace(partial, filename)
+        except Exception:
+            # Never leave a partial file behind
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
 
-        duration = len(audio_data) / (SAMPLE_RATE * CHANNELS * BYTES_PER_SAMPLE)
+        duration = len(pcm) / OUTPUT_SAMPLE_RATE
         print(f"Saved utterance: {filename} ({duration:.2f}s)")
 
     def cleanup(self):
         """Save any remaining audio when recording stops."""
-        for user_id in list(self.user_buffers.keys()):
-            if self.user_buffers[user_id]:
+        for user_id, state in list(self.users.items()):
+            if state.buffer:
                 self._save_utterance(user_id)
+        # Let queued saves finish in the background; later saves become no-ops
+        self.finished = True
+        self._io_pool.shutdown(wait=False)
 
 
 # Bot setup
@@ -275,5 +451,6 @@ if __name__ == "__main__":
         print("Error: DISCORD_BOT_TOKEN environment variable not set!")
         exit(1)
 
+    install_output_filter()
     print("Starting Discord bot...")
     bot.run(DISCORD_TOKEN)
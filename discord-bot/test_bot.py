@@ -2,50 +2,147 @@
 
 import struct
 import os
+import shutil
+import subprocess
+import sys
+import textwrap
+import threading
+import wave
 import tempfile
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import ANY, Mock, patch, MagicMock
 
+import numpy as np
 import pytest
 
 
-class TestFilteredOutput:
-    """Tests for FilteredOutput class."""
+class TestFilterPipe:
+    """Tests for the stdout/stderr noise filter."""
 
-    def test_filters_opus_messages(self):
-        from bot import FilteredOutput
+    def _run_filter(self, text):
+        from bot import _filter_pipe
 
-        mock_original = Mock()
-        filtered = FilteredOutput(mock_original)
+        in_read, in_write = os.pipe()
+        out_read, out_write = os.pipe()
+        os.write(in_write, text)
+        os.close(in_write)
 
-        filtered.write("opus error occurred")
-        mock_original.write.assert_not_called()
+        _filter_pipe(in_read, out_write)
+        os.close(out_write)
+        with open(out_read, "rb") as f:
+            return f.read()
 
-    def test_filters_decode_messages(self):
-        from bot import FilteredOutput
+    def test_filters_opus_messages(self):
+        assert self._run_filter(b"opus error occurred\n") == b""
 
-        mock_original = Mock()
-        filtered = FilteredOutput(mock_original)
+    def test_filters_decode_messages(self):
+        assert self._run_filter(b"decode failed\n") == b""
 
-        filtered.write("decode failed")
-        mock_original.write.assert_not_called()
+    def test_filters_case_insensitively(self):
+        assert self._run_filter(b"An Error Occurred in OPUS\n") == b""
 
     def test_passes_normal_messages(self):
-        from bot import FilteredOutput
+        assert self._run_filter(b"normal log message\n") == b"normal log message\n"
+
+    def test_filters_line_by_line(self):
+        text = b"Bot is ready!\nopus decode failed\nSaved utterance\n"
+        assert self._run_filter(text) == b"Bot is ready!\nSaved utterance\n"
+
+    def test_keeps_draining_after_output_breaks(self):
+        from bot import _filter_pipe
+
+        in_read, in_write = os.pipe()
+        out_read, out_write = os.pipe()
+        os.close(out_read)  # Writes to out_write now fail with EPIPE
+        # More than a pipe buffer's worth, so a stalled reader would block this write
+        os.set_blocking(in_write, False)
+        thread = threading.Thread(target=_filter_pipe, args=(in_read, out_write))
+        thread.start()
+        try:
+            for _ in range(10000):
+                while True:
+                    try:
+                        os.write(in_write, b"normal log message\n")
+                        break
+                    except BlockingIOError:
+                        assert thread.is_alive()
+        finally:
+            os.close(in_write)
+            thread.join(timeout=5)
+            os.close(out_write)
+        assert not thread.is_alive()
+
+    def test_install_output_filter_end_to_end(self):
+        script = textwrap.dedent("""
+            import os, sys
+            import bot
+            bot.install_output_filter()
+            print("Bot is ready!", flush=True)
+            print("opus decode failed", flush=True)
+            os.write(1, b"raw fd line\\n")
+            os.write(2, b"An error occurred while decoding\\n")
+            print("Saved utterance", file=sys.stderr)
+            print("Exiting")
+        """)
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            timeout=60,
+        )
+
+        assert result.returncode == 0, result.stderr
+        assert result.stdout == b"Bot is ready!\nraw fd line\nExiting\n"
+        assert result.stderr == b"Saved utterance\n"
+
+
+class TestSileroVAD:
+    """Tests for the Silero second-pass windowing."""
+
+    def _silero(self, probs):
+        from bot import SileroVAD
+
+        calls = []
 
-        mock_original = Mock()
-        filtered = FilteredOutput(mock_original)
+        def run(_outputs, inputs):
+            calls.append({k: np.copy(v) for k, v in inputs.items()})
+            # Return a distinct state each call so hand-off can be checked
+            state = np.full((2, 1, 128), len(calls), dtype=np.float32)
+            return np.array([[probs[len(calls) - 1]]], dtype=np.float32), state
 
-        filtered.write("normal log message")
-        mock_original.write.assert_called_once_with("normal log message")
+        silero = SileroVAD.__new__(SileroVAD)
+        silero.session = Mock()
+        silero.session.run.side_effect = run
+        return silero, calls
 
-    def test_flush_calls_original(self):
-        from bot import FilteredOutput
+    def test_windows_carry_context_and_state(self):
+        silero, calls = self._silero([0.1, 0.1, 0.1])
+        audio = np.arange(512 * 3, dtype=np.float32)
 
-        mock_original = Mock()
-        filtered = FilteredOutput(mock_original)
+        assert silero.is_speech(audio) is False
 
-        filtered.flush()
-        mock_original.flush.assert_called_once()
+        assert len(calls) == 3
+        for i, call in enumerate(calls):
+            x = call["input"]
+            assert x.shape == (1, 576)
+            assert x.dtype == np.float32
+            # Leading 64 samples are the previous window's tail
+            expected_context = audio[i * 512 - 64:i * 512] if i else np.zeros(64)
+            assert np.array_equal(x[0, :64], expected_context)
+            assert np.array_equal(x[0, 64:], audio[i * 512:(i + 1) * 512])
+            assert np.all(call["state"] == i)
+            assert call["sr"] == 16000
+
+    def test_stops_at_first_window_over_threshold(self):
+        silero, calls = self._silero([0.1, 0.9, 0.2])
+
+        assert silero.is_speech(np.zeros(512 * 3, dtype=np.float32)) is True
+        assert len(calls) == 2
+
+    def test_ignores_trailing_partial_window(self):
+        silero, calls = self._silero([0.1])
+
+        assert silero.is_speech(np.zeros(512 + 100, dtype=np.float32)) is False
+        assert len(calls) == 1
 
 
 class TestVADAudioSink:
@@ -90,29 +187,88 @@ class TestVADAudioSink:
         result = struct.unpack("<h", mono)[0]
         assert result == 0
 
+    def test_stereo_to_mono_full_scale_no_overflow(self, sink):
+        # Full-scale samples must not wrap around when summed
+        stereo = struct.pack("<4h", 32767, 32767, -32768, -32767)
+
+        mono = sink._stereo_to_mono(stereo)
+
+        results = struct.unpack("<2h", mono)
+        assert results == (32767, -32768)
+
     def test_write_ignores_none_user(self, sink):
         sink.write(b"audio data", None)
-        assert len(sink.user_buffers) == 0
+        assert len(sink.users) == 0
 
     def test_write_ignores_none_data(self, sink):
         sink.write(None, 12345)
-        assert len(sink.user_buffers) == 0
+        assert len(sink.users) == 0
 
-    def test_write_increments_frame_count(self, sink):
-        user_id = 12345
-        sink.write(b"x" * 100, user_id)
-        assert sink.user_frame_count[user_id] == 1
+    def test_write_checks_vad_on_every_frame(self, sink):
+        from bot import FRAME_SIZE, VAD_SMOOTHING_THRESHOLD
+        sink.vad.is_speech = Mock(return_value=True)
+
+        for _ in range(VAD_SMOOTHING_THRESHOLD):
+            sink.write(b"\x00" * FRAME_SIZE, 12345)
+
+        assert sink.vad.is_speech.call_count == VAD_SMOOTHING_THRESHOLD
+        assert sink.users[12345].speaking is True
+
+    def test_write_coalesces_partial_frames(self, sink):
+        from bot import FRAME_SIZE
+        sink.vad.is_speech = Mock(return_value=False)
+
+        # Two half packets make up exactly one VAD frame
+        sink.write(b"\x00" * (FRAME_SIZE // 2), 12345)
+        assert sink.vad.is_speech.call_count == 0
+        sink.write(b"\x00" * (FRAME_SIZE // 2), 12345)
+        assert sink.vad.is_speech.call_count == 1
+        assert len(sink.users[12345].mono_tail) == 0
+
+    def test_write_ignores_isolated_speech_frame(self, sink):
+        from bot import FRAME_SIZE
+        sink.vad.is_speech = Mock(side_effect=[True, False, False, True, False])
+
+        for _ in range(5):
+            sink.write(b"\x00" * FRAME_SIZE, 12345)
+
+        assert sink.users[12345].speaking is False
+
+    def test_write_buffers_starting_packet_once(self, sink):
+        from bot import FRAME_SIZE
+        sink.vad.is_speech = Mock(return_value=True)
+
+        # One packet long enough to start speech partway through
+        packet = b"\x01\x00" * (FRAME_SIZE * 2)
+        sink.write(packet, 12345)
+
+        assert sink.users[12345].speaking is True
+        assert sink.users[12345].buffer == packet
+
+    def test_write_saves_after_silence(self, sink):
+        from bot import FRAME_SIZE, MIN_SPEECH_FRAMES, SILENCE_FRAMES
+        sink._save_utterance = Mock()
+        sink.vad.is_speech = Mock(return_value=True)
+        for _ in range(MIN_SPEECH_FRAMES + 2):
+            sink.write(b"\x00" * FRAME_SIZE, 12345)
+
+        sink.vad.is_speech = Mock(return_value=False)
+        for _ in range(SILENCE_FRAMES + 2):
+            sink.write(b"\x00" * FRAME_SIZE, 12345)
+
+        sink._save_utterance.assert_called_once_with(12345)
+        assert sink.users[12345].speaking is False
 
     def test_user_buffers_isolated(self, sink):
         # Different users should have separate buffers
-        sink.user_speaking[111] = True
-        sink.user_speaking[222] = True
+        sink.users[111].speaking = True
+        sink.users[222].speaking = True
 
         sink.write(b"audio1", 111)
         sink.write(b"audio2", 222)
 
-        assert sink.user_buffers[111] == [b"audio1"]
-        assert sink.user_buffers[222] == [b"audio2"]
+        assert sink.users[111].buffer == b"audio1"
+        assert sink.users[222].buffer == b"audio2"
 
     def test_check_speech_returns_false_for_short_data(self, sink):
         result = sink._check_speech(b"short")
@@ -126,7 +282,7 @@ class TestVADAudioSink:
         assert result is False
 
     def test_cleanup_saves_remaining_audio(self, sink):
-        sink.user_buffers[123] = [b"remaining audio"]
+        sink.users[123].buffer = bytearray(b"remaining audio")
         sink._save_utterance = Mock()
 
         sink.cleanup()
@@ -134,7 +290,7 @@ class TestVADAudioSink:
         sink._save_utterance.assert_called_once_with(123)
 
     def test_cleanup_handles_empty_buffers(self, sink):
-        sink.user_buffers[123] = []
+        sink.users[123].buffer = bytearray()
         sink._save_utterance = Mock()
 
         sink.cleanup()
@@ -157,9 +313,9 @@ class TestSaveUtterance:
         with tempfile.TemporaryDirectory() as tmpdir:
             with patch('bot.AUDIO_OUTPUT_DIR', tmpdir):
                 # Add some audio data
-                sink.user_buffers[123] = [b'\x00\x00' * 1000]
+                sink.users[123].buffer = bytearray(b'\x00\x00' * 1000)
 
-                sink._save_utterance(123)
+                sink._save_utterance(123).result()
 
                 # Check a wav file was created
                 files = os.listdir(tmpdir)
@@ -167,11 +323,137 @@ class TestSaveUtterance:
                 assert files[0].startswith("user_123_")
                 assert files[0].endswith(".wav")
 
+    def test_save_utterance_writes_valid_wav(self, sink):
+        from bot import OUTPUT_SAMPLE_RATE, OUTPUT_CHANNELS, BYTES_PER_SAMPLE
+        audio = b'\x00\x00' * 2 * 4800  # 100ms of 48kHz stereo silence
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch('bot.AUDIO_OUTPUT_DIR', tmpdir):
+                sink.users[123].buffer = bytearray(audio)
+
+                sink._save_utterance(123).result()
+
+                path = os.path.join(tmpdir, os.listdir(tmpdir)[0])
+                with wave.open(path, "rb") as wf:
+                    assert wf.getnchannels() == OUTPUT_CHANNELS
+                    assert wf.getsampwidth() == BYTES_PER_SAMPLE
+                    assert wf.getframerate() == OUTPUT_SAMPLE_RATE
+                    assert wf.readframes(wf.getnframes()) == b'\x00\x00' * 1600
+
+    def test_save_utterance_dropped_by_silero(self, sink):
+        sink.silero = Mock()
+        sink.silero.is_speech.return_value = False
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch('bot.AUDIO_OUTPUT_DIR', tmpdir):
+                sink.users[123].buffer = bytearray(b'\x00\x00' * 1000)
+
+                sink._save_utterance(123).result()
+
+                assert os.listdir(tmpdir) == []
+
+    def test_resample_output_is_16khz_mono(self, sink):
+        from bot import SAMPLE_RATE, OUTPUT_SAMPLE_RATE
+        stereo = b'\x00\x00' * 2 * SAMPLE_RATE  # One second
+
+        audio = sink._resample_output(stereo)
+
+        assert audio.dtype == np.float32
+        assert audio.shape == (OUTPUT_SAMPLE_RATE,)
+
+    def test_resample_output_keeps_int16_scale(self, sink):
+        from bot import SAMPLE_RATE
+        stereo = struct.pack("<2h", 1000, 1000) * SAMPLE_RATE
+
+        audio = sink._resample_output(stereo)
+
+        # Away from the filter edges a DC input passes through unchanged
+        assert np.allclose(audio[100:-100], 1000, atol=1)
+
     def test_save_utterance_empty_buffer_noop(self, sink):
-        sink.user_buffers[123] = []
+        sink.users[123].buffer = bytearray()
 
         # Should not raise
-        sink._save_utterance(123)
+        assert sink._save_utterance(123) is None
+
+    def test_save_utterance_takes_buffer(self, sink):
+        sink._save_utterance_sync = Mock()
+        sink.users[123].buffer = bytearray(b"audio")
+
+        sink._save_utterance(123).result()
+
+        sink._save_utterance_sync.assert_called_once_with(123, ANY, bytearray(b"audio"))
+        assert sink.users[123].buffer == b""
+
+    def test_save_utterance_same_second_keeps_both(self, sink):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch('bot.AUDIO_OUTPUT_DIR', tmpdir):
+                sink.users[123].buffer = bytearray(b'\x00\x00' * 2 * 48000 * 3)
+                first = sink._save_utterance(123)
+                sink.users[123].buffer = bytearray(b'\x00\x00' * 2 * 4800)
+                second = sink._save_utterance(123)
+                first.result()
+                second.result()
+
+                files = sorted(os.listdir(tmpdir))
+                assert len(files) == 2
+                assert all(f.endswith(".wav") for f in files)
+
+    def test_save_utterance_after_cleanup_is_noop(self, sink):
+        sink.cleanup()
+        sink.users[123].buffer = bytearray(b"late audio")
+
+        # Must not raise on the shut-down pool
+        assert sink._save_utterance(123) is None
+
+    def test_save_utterance_handles_short_writes(self, sink):
+        real_writev = os.writev
+
+        def short_writev(fd, buffers):
+            # Write at most 100 bytes per call
+            return real_writev(fd, [bytes(buffers[0][:100])])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch('bot.AUDIO_OUTPUT_DIR', tmpdir):
+                with patch('bot.os.writev', side_effect=short_writev):
+                    sink.users[123].buffer = bytearray(b'\x01\x00' * 2 * 4800)
+                    sink._save_utterance(123).result()
+
+                path = os.path.join(tmpdir, os.listdir(tmpdir)[0])
+                with wave.open(path, "rb") as wf:
+                    assert wf.getnframes() == 1600
+                    assert len(wf.readframes(1600)) == 3200
+
+    def test_save_utterance_failed_write_leaves_no_partial(self, sink):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch('bot.AUDIO_OUTPUT_DIR', tmpdir):
+                with patch('bot.os.writev', side_effect=OSError("No space left")):
+                    sink.users[123].buffer = bytearray(b'\x00\x00' * 2 * 4800)
+                    sink._save_utterance(123).result()
+
+                assert os.listdir(tmpdir) == []
+
+    def test_save_utterance_recreates_missing_dir(self, sink):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outdir = os.path.join(tmpdir, "audio")
+            with patch('bot.AUDIO_OUTPUT_DIR', outdir):
+                sink.users[123].buffer = bytearray(b'\x00\x00' * 2 * 4800)
+                sink._save_utterance(123).result()
+                assert len(os.listdir(outdir)) == 1
+
+                # Directory removed at runtime - the next save still lands
+                shutil.rmtree(outdir)
+                sink.users[123].buffer = bytearray(b'\x00\x00' * 2 * 4800)
+                sink._save_utterance(123).result()
+                assert len(os.listdir(outdir)) == 1
+
+    def test_save_utterance_reports_errors(self, sink, capsys):
+        with patch('bot.tempfile.mkstemp', side_effect=PermissionError("denied")):
+            sink.users[123].buffer = bytearray(b"\x00\x00")
+
+            sink._save_utterance(123).result()
+
+        assert "Error saving utterance for user_123" in capsys.readouterr().out
 
 
 class TestConfigValues: